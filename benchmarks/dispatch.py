@@ -0,0 +1,100 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Measure the per-call overhead ZlibStorage adds to its base storage
+
+The base storage is a trivial in-memory storage, so the times shown
+are the cost of the wrapper's method dispatch and record header
+checks.  Records are stored and transformed too small to compress and
+are loaded as raw pickles or, in the "compressed" case, as a small
+compressed record, which includes the cost of decompressing it.
+
+Usage: python benchmarks/dispatch.py [number]
+"""
+import sys
+import timeit
+import zlib
+
+import ZODB.utils
+
+import zc.zlibstorage
+
+
+class Base:
+
+    def __init__(self, data):
+        self.data = data
+
+    def registerDB(self, db):
+        pass
+
+    def load(self, oid, version=''):
+        return self.data, ZODB.utils.z64
+
+    def loadBefore(self, oid, tid):
+        return self.data, ZODB.utils.z64, None
+
+    def loadSerial(self, oid, serial):
+        return self.data
+
+    def store(self, oid, serial, data, version, transaction):
+        pass
+
+    # What the database does, which is what a storage without a
+    # wrapper would do:
+
+    def transform_record_data(self, data):
+        return data
+
+    untransform_record_data = transform_record_data
+
+
+RAW = b'cpersistent.mapping\nPersistentMapping\nq\x00.'
+COMPRESSED = b'.z' + zlib.compress(b'x' * 200)
+
+CALLS = (
+    ('load', 's.load(oid)'),
+    ('loadBefore', 's.loadBefore(oid, oid)'),
+    ('loadSerial', 's.loadSerial(oid, oid)'),
+    ('store', 's.store(oid, oid, small, "", None)'),
+    ('transform', 's.transform_record_data(small)'),
+)
+
+
+def measure(storage, call, number):
+    namespace = dict(s=storage, oid=ZODB.utils.z64, small=b'x')
+    return min(timeit.repeat(
+        call, globals=namespace, number=number, repeat=7)) / number
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    number = int(args[0]) if args else 200000
+    for name, data, options in (
+            ('raw', RAW, {}),
+            ('compressed', COMPRESSED, {}),
+            ('policy', RAW, dict(policy=zc.zlibstorage.Policy())),
+            ('no compress', RAW, dict(compress=False)),
+    ):
+        base = Base(data)
+        storage = zc.zlibstorage.ZlibStorage(base, **options)
+        storage.registerDB(base)
+        for method, call in CALLS:
+            overhead = (measure(storage, call, number)
+                        - measure(base, call, number))
+            print('%-12s %-11s %6.0f ns' % (name, method, overhead * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,11 +11,24 @@
 # FOR A PARTICULAR PURPOSE.
 #
 ##############################################################################
+import collections
+import concurrent.futures
+import fnmatch
+import functools
+import importlib
+import struct
+import threading
+import time
 import zlib
 
 import ZODB.interfaces
+import ZODB.POSException
+import ZODB.utils
 import zope.interface
 
+from zc.zlibstorage.monitor import Monitor  # noqa: F401 (API)
+from zc.zlibstorage.recompress import Recompressor
+
 
 @zope.interface.implementer(
     ZODB.interfaces.IStorageWrapper,
@@ -23,56 +36,297 @@ import zope.interface
 class ZlibStorage:
 
     copied_methods = (
-        'close', 'getName', 'getSize', 'history', 'isReadOnly',
+        'getName', 'getSize', 'history', 'isReadOnly',
         'lastTransaction', 'new_oid', 'sortKey',
         'tpc_abort', 'tpc_begin', 'tpc_finish', 'tpc_vote',
         'loadBlob', 'openCommittedBlobFile', 'temporaryDirectory',
         'supportsUndo', 'undo', 'undoLog', 'undoInfo',
     )
 
-    def __init__(self, base, *args, **kw):
+    def __init__(self, base, compress=True, *, policy=None,
+                 max_record_size=None, pipeline=False, revision_cache_size=0,
+                 stages=(), strict_stages=True, monitor=None):
         self.base = base
-
-        # Sorry for the lambda hijinks below, but I really want to use
-        # the name "compress" for both the module-level function name
-        # and for the argument to this function. :/
-        if (lambda compress=True: compress)(*args, **kw):
-            self._transform = compress  # Refering to module func below!
-        else:
+        # The compress argument hides the module-level function.
+        compressing, compress = compress, _compress
+        if monitor is not None and 'store' in self.copied_methods:
+            raise ValueError(
+                "Server storages don't transform records when loading and"
+                " storing them, so can't monitor them")
+        if stages:
+            transform = Transform(stages, compressing, policy, max_record_size,
+                                  strict_stages)
+            self._transform = functools.partial(transform.encode, None)
+            self._store_transform = transform.encode
+        elif not compressing:
             self._transform = lambda data: data
-        self._untransform = decompress
+            self._store_transform = lambda oid, data: data
+        elif policy is None:
+            self._transform = compress
+            self._store_transform = lambda oid, data: compress(data)
+        else:
+            self._transform = functools.partial(policy.compress, None)
+            self._store_transform = policy.compress
+        self.policy = policy
+        self.max_record_size = max_record_size
+        self.stages = tuple(stages)
+        self.strict_stages = strict_stages
+        if stages:
+            self._untransform = transform.decode
+        elif max_record_size is None:
+            self._untransform = decompress
+        else:
+            self._untransform = functools.partial(
+                decompress, max_size=max_record_size)
+        if revision_cache_size:
+            self.revision_cache = RevisionCache(revision_cache_size)
+
+        self._bind_record_transforms()
+        self.monitor = monitor
+        if monitor is None:
+            self._bind_loads()
+            self._bind_stores(
+                compressing and policy is None and not stages,
+                not (compressing or stages))
+        else:
+            self._bind_monitored(monitor)
+        self._use_bound('load', 'loadBefore', 'loadSerial', 'store')
 
         for name in self.copied_methods:
             v = getattr(base, name, None)
             if v is not None:
                 setattr(self, name, v)
 
+        self.pipeline = pipeline and 'store' not in self.copied_methods
+        if self.pipeline:
+            # Compress records in a separate thread while the previous
+            # record is written to the base storage.
+            self._compressor = concurrent.futures.ThreadPoolExecutor(
+                1, 'zc.zlibstorage')
+            self._pipelined = {}  # {transaction: pending store}
+            self._store = self._pipeline_store
+            self._use_bound('store')
+            self.tpc_vote = self._pipeline_tpc_vote
+            self.tpc_abort = self._pipeline_tpc_abort
+
         zope.interface.directlyProvides(self, zope.interface.providedBy(base))
 
         base.registerDB(self)
 
+    db = recompressor = revision_cache = None
+
     def __getattr__(self, name):
         return getattr(self.base, name)
 
+    def close(self):
+        if self.recompressor is not None:
+            self.recompressor.stop()
+        if self.pipeline:
+            self._compressor.shutdown()
+        return self.base.close()
+
     def __len__(self):
         return len(self.base)
 
+    # The load, loadBefore, loadSerial, store, transform_record_data
+    # and untransform_record_data methods call the closures bound at
+    # construction by the _bind_* methods below, which are used
+    # directly, saving this call, unless a subclass overrides them.
+
     def load(self, oid, version=''):
-        data, serial = self.base.load(oid, version)
-        return self._untransform(data), serial
+        return self._load(oid, version)
 
     def loadBefore(self, oid, tid):
-        r = self.base.loadBefore(oid, tid)
-        if r is not None:
-            data, serial, after = r
-            return self._untransform(data), serial, after
-        else:
-            return r
+        return self._loadBefore(oid, tid)
 
     def loadSerial(self, oid, serial):
-        return self._untransform(self.base.loadSerial(oid, serial))
+        return self._loadSerial(oid, serial)
+
+    def store(self, oid, serial, data, version, transaction):
+        return self._store(oid, serial, data, version, transaction)
+
+    def transform_record_data(self, data):
+        return self._transform_record_data(data)
+
+    def untransform_record_data(self, data):
+        return self._untransform_record_data(data)
+
+    def _use_bound(self, *names):
+        cls = type(self)
+        for name in names:
+            bound = self.__dict__.get('_' + name)
+            if bound is not None and (
+                    getattr(cls, name) is getattr(ZlibStorage, name)):
+                setattr(self, name, bound)
+
+    def _bind_loads(self):
+        # Loads are by far the most frequent storage calls.  Implement
+        # the load methods above with closures over the
+        # base storage's methods that check for transformed records
+        # inline, saving attribute lookups and, for untransformed
+        # records, a call per load.  Transformed records start with a
+        # period, the pickle STOP opcode, which can't start a pickle.
+        untransform = self._untransform
+        base_load = getattr(self.base, 'load', None)
+        base_loadBefore = getattr(self.base, 'loadBefore', None)
+        base_loadSerial = getattr(self.base, 'loadSerial', None)
+
+        if base_load is not None:
+            def load(oid, version=''):
+                data, serial = base_load(oid, version)
+                if data[:1] == b'.':
+                    try:
+                        data = untransform(data)
+                    except RecordTooLarge as v:
+                        raise v.naming(oid, serial) from None
+                return data, serial
+            self._load = load
+
+        if base_loadBefore is not None:
+            def loadBefore(oid, tid):
+                r = base_loadBefore(oid, tid)
+                if r is not None and r[0][:1] == b'.':
+                    data, serial, after = r
+                    try:
+                        return untransform(data), serial, after
+                    except RecordTooLarge as v:
+                        raise v.naming(oid, serial) from None
+                return r
+            self._loadBefore = loadBefore
+
+        cache = self.revision_cache
+        if base_loadSerial is not None and cache is None:
+            def loadSerial(oid, serial):
+                data = base_loadSerial(oid, serial)
+                if data[:1] == b'.':
+                    try:
+                        data = untransform(data)
+                    except RecordTooLarge as v:
+                        raise v.naming(oid, serial) from None
+                return data
+            self._loadSerial = loadSerial
+        elif base_loadSerial is not None:
+            def loadSerial(oid, serial):
+                data = cache.get((oid, serial))
+                if data is None:
+                    data = base_loadSerial(oid, serial)
+                    if data[:1] == b'.':
+                        try:
+                            data = untransform(data)
+                        except RecordTooLarge as v:
+                            raise v.naming(oid, serial) from None
+                        cache.put((oid, serial), data)
+                return data
+            self._loadSerial = loadSerial
+
+    def _bind_stores(self, compress_only, identity):
+        # Like _bind_loads, for stores.  When records are compressed
+        # without a policy or stages, the compression function is
+        # called directly, and when they aren't transformed at all,
+        # the base storage's store method is used as is.
+        base_store = getattr(self.base, 'store', None)
+        if base_store is None:
+            return
+        if identity:
+            self._store = base_store
+        elif compress_only:
+            def store(oid, serial, data, version, transaction):
+                return base_store(oid, serial, compress(data), version,
+                                  transaction)
+            self._store = store
+        else:
+            store_transform = self._store_transform
+
+            def store(oid, serial, data, version, transaction):
+                return base_store(oid, serial, store_transform(oid, data),
+                                  version, transaction)
+            self._store = store
+
+    def _bind_record_transforms(self):
+        # Bind transform_record_data and untransform_record_data to
+        # our transformations and, once there's one, the database's.
+        # This is done again by registerDB.
+        transform = self._transform
+        untransform = self._untransform
+        if self.db is None:
+            self._transform_record_data = transform
+            self._untransform_record_data = untransform
+            self._use_bound('transform_record_data', 'untransform_record_data')
+            return
+        db_transform = self._db_transform
+        db_untransform = self._db_untransform
+
+        def transform_record_data(data):
+            return transform(db_transform(data))
+        self._transform_record_data = transform_record_data
+
+        def untransform_record_data(data):
+            return db_untransform(untransform(data))
+        self._untransform_record_data = untransform_record_data
+        self._use_bound('transform_record_data', 'untransform_record_data')
+
+    def _bind_monitored(self, monitor):
+        # Like _bind_loads, but timing the base storage and the
+        # transformation separately.  Revision cache hits aren't
+        # recorded.
+        base = self.base
+        untransform = self._untransform
+        store_transform = self._store_transform
+        cache = self.revision_cache
+        record = monitor.record
+        timer = time.perf_counter
+
+        def load(oid, version=''):
+            start = timer()
+            data, serial = base.load(oid, version)
+            loaded = timer()
+            data = _untransform_record(untransform, data, oid, serial)
+            record('load', oid, data, loaded - start, timer() - loaded)
+            return data, serial
+        self._load = load
+
+        def loadBefore(oid, tid):
+            start = timer()
+            r = base.loadBefore(oid, tid)
+            if r is None:
+                return r
+            loaded = timer()
+            data, serial, after = r
+            data = _untransform_record(untransform, data, oid, serial)
+            record('loadBefore', oid, data, loaded - start, timer() - loaded)
+            return data, serial, after
+        self._loadBefore = loadBefore
+
+        def loadSerial(oid, serial):
+            if cache is not None:
+                data = cache.get((oid, serial))
+                if data is not None:
+                    return data
+            start = timer()
+            data = base.loadSerial(oid, serial)
+            loaded = timer()
+            if data[:1] == b'.':
+                data = _untransform_record(untransform, data, oid, serial)
+                if cache is not None:
+                    cache.put((oid, serial), data)
+            record('loadSerial', oid, data, loaded - start, timer() - loaded)
+            return data
+        self._loadSerial = loadSerial
+
+        def store(oid, serial, data, version, transaction):
+            start = timer()
+            transformed = store_transform(oid, data)
+            transformed_at = timer()
+            result = base.store(oid, serial, transformed, version,
+                                transaction)
+            record('store', oid, data, timer() - transformed_at,
+                   transformed_at - start)
+            return result
+        self._store = store
 
     def pack(self, pack_time, referencesf, gc=None):
+        if self.revision_cache is not None:
+            self.revision_cache.clear()
         _untransform = self._untransform
 
         def refs(p, oids=None):
@@ -86,30 +340,72 @@ class ZlibStorage:
         self.db = db
         self._db_transform = db.transform_record_data
         self._db_untransform = db.untransform_record_data
+        self._bind_record_transforms()
 
     _db_transform = _db_untransform = lambda self, data: data
 
-    def store(self, oid, serial, data, version, transaction):
-        return self.base.store(oid, serial, self._transform(data), version,
-                               transaction)
+    def _pipeline_store(self, oid, serial, data, version, transaction):
+        pipelined = self._pipelined
+        if transaction not in pipelined:
+            # Store the first record directly, so the base storage
+            # checks the transaction right away.
+            self._pipeline_write((oid, serial, data, version, None),
+                                 transaction)
+            pipelined[transaction] = None
+            return
+        pending = pipelined[transaction]
+        pipelined[transaction] = (
+            oid, serial, data, version,
+            self._compressor.submit(self._pipeline_transform, oid, data))
+        if pending is not None:
+            self._pipeline_write(pending, transaction)
+
+    def _pipeline_transform(self, oid, data):
+        start = time.perf_counter()
+        transformed = self._store_transform(oid, data)
+        return transformed, time.perf_counter() - start
+
+    def _pipeline_write(self, pending, transaction):
+        oid, serial, data, version, transformed = pending
+        if transformed is None:
+            transformed, codec_time = self._pipeline_transform(oid, data)
+        else:
+            transformed, codec_time = transformed.result()
+        start = time.perf_counter()
+        self.base.store(oid, serial, transformed, version, transaction)
+        if self.monitor is not None:
+            self.monitor.record('store', oid, data,
+                                time.perf_counter() - start, codec_time)
+
+    def _pipeline_tpc_vote(self, transaction):
+        pending = self._pipelined.pop(transaction, None)
+        if pending is not None:
+            self._pipeline_write(pending, transaction)
+        return self.base.tpc_vote(transaction)
+
+    def _pipeline_tpc_abort(self, transaction):
+        self._pipelined.pop(transaction, None)
+        return self.base.tpc_abort(transaction)
 
     def restore(self, oid, serial, data, version, prev_txn, transaction):
         return self.base.restore(
-            oid, serial, self._transform(data), version, prev_txn, transaction)
+            oid, serial, self._store_transform(oid, data), version, prev_txn,
+            transaction)
 
     def iterator(self, start=None, stop=None):
-        return _Iterator(self.base.iterator(start, stop))
+        return _Iterator(self.base.iterator(start, stop), self._untransform)
 
     def storeBlob(self, oid, oldserial, data, blobfilename, version,
                   transaction):
         return self.base.storeBlob(
-            oid, oldserial, self._transform(data), blobfilename, version,
-            transaction)
+            oid, oldserial, self._store_transform(oid, data), blobfilename,
+            version, transaction)
 
     def restoreBlob(self, oid, serial, data, blobfilename, prev_txn,
                     transaction):
-        return self.base.restoreBlob(oid, serial, self._transform(data),
-                                     blobfilename, prev_txn, transaction)
+        return self.base.restoreBlob(
+            oid, serial, self._store_transform(oid, data), blobfilename,
+            prev_txn, transaction)
 
     def invalidateCache(self):
         return self.db.invalidateCache()
@@ -120,30 +416,404 @@ class ZlibStorage:
     def references(self, record, oids=None):
         return self.db.references(self._untransform(record), oids)
 
-    def transform_record_data(self, data):
-        return self._transform(self._db_transform(data))
-
-    def untransform_record_data(self, data):
-        return self._db_untransform(self._untransform(data))
-
     def record_iternext(self, next=None):
         oid, tid, data, next = self.base.record_iternext(next)
-        return oid, tid, self._untransform(data), next
+        return (oid, tid,
+                _untransform_record(self._untransform, data, oid, tid), next)
 
     def copyTransactionsFrom(self, other):
         ZODB.blob.copyTransactionsFromTo(other, self)
 
+    def recompress(self, **options):
+        """Recompress existing records in a background thread
+
+        See ``zc.zlibstorage.recompress.Recompressor`` for the options.
+        """
+        if self.recompressor is not None:
+            self.recompressor.stop()
+        self.recompressor = Recompressor(self, **options)
+        self.recompressor.start()
+        return self.recompressor
+
 
-def compress(data):
+def compress(data, level=-1):
     if data and (len(data) > 20) and data[:2] != b'.z':
-        compressed = b'.z'+zlib.compress(data)
+        compressed = b'.z'+zlib.compress(data, level)
         if len(compressed) < len(data):
             return compressed
     return data
 
 
-def decompress(data):
-    return data[:2] == b'.z' and zlib.decompress(data[2:]) or data
+_compress = compress  # For ZlibStorage, whose compress argument hides it
+
+
+def decompress(data, max_size=None):
+    if data[:2] != b'.z':
+        if data[:2] == b'.s':
+            raise ZODB.POSException.StorageError(
+                "Record was transformed with stages, which must be"
+                " configured to decode it")
+        return data
+    return _inflate(data[2:], max_size)
+
+
+def record_encoding(data):
+    """Return how a stored record is encoded, leaving out its content
+
+    This is a tuple of the record's header, empty for untransformed
+    records, and, for records compressed without stages, the class of
+    compression level zlib records in its own header: 0 for levels 0
+    and 1, 1 for levels 2 to 5, 2 for level 6, the default, and 3 for
+    levels 7 to 9.  Levels in the same class, and levels used with
+    stages, aren't distinguished.
+    """
+    prefix = data[:2]
+    if prefix == b'.z':
+        return prefix, data[3] >> 6 if len(data) > 3 else None
+    if prefix == b'.s' and len(data) > 2:
+        return data[:3 + data[2]], None
+    return b'', None
+
+
+def _inflate(data, max_size):
+    if max_size is None:
+        return zlib.decompress(data)
+    decompressor = zlib.decompressobj()
+    result = decompressor.decompress(data, max_size + 1)
+    if len(result) > max_size:
+        raise RecordTooLarge(
+            "Decompressed record is larger than the maximum size, %d"
+            % max_size)
+    if not decompressor.eof:
+        raise zlib.error("Error -5 while decompressing data: "
+                         "incomplete or truncated stream")
+    return result
+
+
+class RecordTooLarge(ZODB.POSException.StorageError):
+    """A compressed record decompresses to more than the maximum size
+
+    When raised while loading a record, ``oid`` and ``tid`` identify
+    the record.
+    """
+
+    oid = tid = None
+
+    def naming(self, oid, tid):
+        """Return an error like this one that names the record
+        """
+        error = self.__class__('%s, oid %s, tid %s' % (
+            self, ZODB.utils.oid_repr(oid), ZODB.utils.tid_repr(tid)))
+        error.oid = oid
+        error.tid = tid
+        return error
+
+
+class RevisionCache:
+    """A least-recently-used cache of decompressed object revisions
+
+    Revisions are keyed by oid and serial.  Since a revision never
+    changes, entries need only be discarded when revisions are removed
+    by packing.  The cache holds at most ``size`` bytes of revision
+    data.  ``hits`` counts revisions found in the cache and ``misses``
+    revisions that had to be decompressed and were added to it.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = self.misses = 0
+        self.bytes = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._data.get(key)
+            if data is not None:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            self.misses += 1
+            if len(data) > self.size:
+                return
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self._data[key] = data
+            self.bytes += len(data)
+            while self.bytes > self.size:
+                _, old = self._data.popitem(False)
+                self.bytes -= len(old)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+def _untransform_record(untransform, data, oid, tid):
+    try:
+        return untransform(data)
+    except RecordTooLarge as v:
+        raise v.naming(oid, tid) from None
+
+
+class Rule:
+    """A compression policy rule
+
+    A rule applies to records whose class dotted name matches one of
+    the given ``classes`` glob patterns and whose oid falls in one of
+    the given inclusive ``oids`` ranges.  Omitted criteria match
+    everything.  Matching records are compressed at ``level`` (the
+    policy default if ``None``) or, if ``compress`` is false, stored
+    uncompressed.
+    """
+
+    def __init__(self, classes=(), oids=(), compress=True, level=None):
+        self.classes = tuple(classes)
+        self.oids = tuple((ZODB.utils.p64(first), ZODB.utils.p64(last))
+                          for first, last in oids)
+        self.compress = compress
+        self.level = level
+
+    def matches_class(self, classname):
+        if not self.classes:
+            return True
+        for pattern in self.classes:
+            if fnmatch.fnmatchcase(classname, pattern):
+                return True
+        return False
+
+    def matches_oid(self, oid):
+        if not self.oids:
+            return True
+        if oid is None:
+            return False
+        for first, last in self.oids:
+            if first <= oid <= last:
+                return True
+        return False
+
+
+class Policy:
+    """Choose how to compress each record from a sequence of rules
+
+    The first matching rule wins.  Records that no rule matches are
+    compressed at the default ``level``.
+
+    The rules applicable to a class are computed once per class and
+    cached, so the per-record cost is reading the class name from the
+    pickle header and a dictionary lookup.
+    """
+
+    def __init__(self, rules=(), level=-1):
+        self.rules = tuple(rules)
+        self.level = level
+        self._by_class = {}
+        self._class_rules = any(rule.classes for rule in self.rules)
+
+    def _rules_for(self, data):
+        if not self._class_rules:
+            return self.rules
+        try:
+            classname = '.'.join(ZODB.utils.get_pickle_metadata(data))
+        except Exception:
+            classname = ''  # Not a pickle we can read
+        try:
+            return self._by_class[classname]
+        except KeyError:
+            rules = self._by_class[classname] = tuple(
+                rule for rule in self.rules if rule.matches_class(classname))
+            return rules
+
+    def choose(self, oid, data):
+        """Return the compression level for a record, or ``None``
+        """
+        for rule in self._rules_for(data):
+            if rule.matches_oid(oid):
+                if not rule.compress:
+                    return None
+                if rule.level is not None:
+                    return rule.level
+                break
+        return self.level
+
+    def compress(self, oid, data):
+        """Compress the record for the given oid (or ``None``)
+        """
+        if not data or data[:2] == b'.z':
+            return data
+        level = self.choose(oid, data)
+        if level is None:
+            return data
+        return compress(data, level)
+
+
+def oid_range(value):
+    """Convert an oid or ``first-last`` oid range to a pair of integers
+    """
+    first, sep, last = value.partition('-')
+    first = int(first.strip(), 0)
+    last = int(last.strip(), 0) if sep else first
+    if first > last:
+        raise ValueError("Invalid oid range", value)
+    return first, last
+
+
+class Transform:
+    """Compress records and apply additional stages in a single pass
+
+    Records are compressed, if worthwhile, and then passed through
+    each stage's ``encode`` method in order.  A single header, ``.s``
+    followed by a count and the one-byte tags of the steps applied,
+    records how to undo the steps.  Stages are passed the header, so
+    they can authenticate it.  Records are decoded by applying the
+    stages' ``decode`` methods in reverse order and then
+    decompressing.
+
+    If ``strict`` is true, records that weren't passed through all of
+    the stages, including uncompressed records and records compressed
+    without stages, with a ``.z`` prefix, are rejected when decoded.
+    Otherwise they're still decoded.
+    """
+
+    def __init__(self, stages, compress=True, policy=None,
+                 max_record_size=None, strict=True):
+        self.stages = tuple(stages)
+        self.compress = compress
+        self.policy = policy
+        self.max_record_size = max_record_size
+        self.strict = strict
+        tags = b''.join(stage.tag for stage in self.stages)
+        if (any(len(stage.tag) != 1 for stage in self.stages)
+                or len(set(tags)) != len(tags) or b'z' in tags):
+            raise ValueError(
+                "Stage tags must be distinct single bytes other than z", tags)
+        self._header = b'.s' + bytes((len(tags),)) + tags
+        self._compressed_header = b'.s' + bytes((len(tags) + 1,)) + b'z' + tags
+        self._tags = frozenset(tags)
+        self._encoders = tuple(stage.encode for stage in self.stages)
+        self._decoders = {stage.tag[0]: stage.decode for stage in self.stages}
+
+    def encode(self, oid, data):
+        """Transform the record for the given oid (or ``None``)
+        """
+        if not data or data[:2] == b'.s':
+            return data
+        if data[:2] == b'.z':
+            # Compressed without stages, which must still be applied
+            data = _inflate(data[2:], self.max_record_size)
+        header = self._header
+        if self.compress and len(data) > 20:
+            level = -1 if self.policy is None else self.policy.choose(
+                oid, data)
+            if level is not None:
+                compressed = zlib.compress(data, level)
+                if len(compressed) < len(data):
+                    data = compressed
+                    header = self._compressed_header
+        for encode in self._encoders:
+            data = encode(data, header)
+        return header + data
+
+    def decode(self, data):
+        """Undo the transformation of a record
+        """
+        prefix = data[:2]
+        if prefix != b'.s':
+            if self.strict and data:
+                raise ZODB.POSException.StorageError(
+                    "Record wasn't transformed with the configured stages")
+            if prefix == b'.z':
+                return _inflate(data[2:], self.max_record_size)
+            return data
+        if len(data) < 3 or len(data) < 3 + data[2]:
+            raise ZODB.POSException.StorageError(
+                "Truncated record header", data[:12])
+        end = 3 + data[2]
+        header = data[:end]
+        tags = data[3:end]
+        if self.strict and not self._tags.issubset(tags):
+            raise ZODB.POSException.StorageError(
+                "Record wasn't transformed with the configured stages",
+                header)
+        data = data[end:]
+        decoders = self._decoders
+        for tag in reversed(tags):
+            if tag in decoders:
+                data = decoders[tag](data, header)
+            elif tag == 122:  # z
+                data = _inflate(data, self.max_record_size)
+            else:
+                raise ZODB.POSException.StorageError(
+                    "Unknown record transformation", bytes((tag,)))
+        return data
+
+
+class Checksum:
+    """A transform stage that appends and verifies a CRC-32 checksum
+
+    The checksum covers the record header as well as the data.
+    """
+
+    tag = b'c'
+
+    def encode(self, data, header):
+        return data + struct.pack('>I', zlib.crc32(data, zlib.crc32(header)))
+
+    def decode(self, data, header):
+        body = data[:-4]
+        checksum = zlib.crc32(body, zlib.crc32(header))
+        if struct.pack('>I', checksum) != data[-4:]:
+            raise ChecksumError("Record checksum doesn't match")
+        return body
+
+
+class ChecksumError(ZODB.POSException.StorageError):
+    """A record's checksum doesn't match its data
+    """
+
+
+class Encryption:
+    """A transform stage that encrypts records with pluggable functions
+
+    ``encrypt`` and ``decrypt`` take the data and the record header,
+    as bytes, and return bytes.  They should provide authenticated
+    encryption with the header as associated data, as AES-GCM does,
+    so that decryption fails for records, or headers, that have been
+    tampered with.
+    """
+
+    def __init__(self, encrypt, decrypt, tag=b'e'):
+        self.encode = encrypt
+        self.decode = decrypt
+        self.tag = tag
+
+
+def stage(value):
+    """Create a transform stage by calling a dotted-name factory
+
+    The factory is called without arguments, so stages that need
+    them, like ``Encryption``, are configured with functions that
+    create them.
+    """
+    module, _, name = value.strip().rpartition('.')
+    return getattr(importlib.import_module(module), name)()
+
+
+def compression_level(value):
+    """Convert a zlib compression level, -1 (the default) through 9
+    """
+    level = int(value)
+    if not -1 <= level <= 9:
+        raise ValueError("Invalid compression level", value)
+    return level
 
 
 class ServerZlibStorage(ZlibStorage):
@@ -164,14 +834,15 @@ class _Iterator:
     # as well as avoiding any GC issues.
     # (https://github.com/zopefoundation/zc.zlibstorage/issues/4)
 
-    def __init__(self, base_it):
+    def __init__(self, base_it, untransform=decompress):
         self._base_it = base_it
+        self._untransform = untransform
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        return Transaction(next(self._base_it))
+        return Transaction(next(self._base_it), self._untransform)
 
     next = __next__
 
@@ -191,13 +862,15 @@ class _Iterator:
 
 class Transaction:
 
-    def __init__(self, trans):
+    def __init__(self, trans, untransform=decompress):
         self.__trans = trans
+        self.__untransform = untransform
 
     def __iter__(self):
         for r in self.__trans:
             if r.data:
-                r.data = decompress(r.data)
+                r.data = _untransform_record(
+                    self.__untransform, r.data, r.oid, r.tid)
             yield r
 
     def __getattr__(self, name):
@@ -217,7 +890,21 @@ class ZConfig:
         compress = self.config.compress
         if compress is None:
             compress = True
-        return self._factory(base, compress)
+        policy = None
+        rules = [Rule(section.classes, section.oids, section.compress,
+                      section.level)
+                 for section in self.config.policies]
+        if rules or self.config.level is not None:
+            level = self.config.level
+            policy = Policy(rules, -1 if level is None else level)
+        return self._factory(base, compress, policy=policy,
+                             max_record_size=self.config.max_record_size,
+                             pipeline=self.config.pipeline,
+                             revision_cache_size=(
+                                 self.config.revision_cache_size),
+                             stages=self.config.stages,
+                             strict_stages=self.config.strict_stages,
+                             monitor=getattr(self.config, 'monitor', None))
 
 
 class ZConfigServer(ZConfig):
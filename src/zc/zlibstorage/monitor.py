@@ -0,0 +1,154 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Latency histograms and slow-record tracing for storage operations
+"""
+import bisect
+import heapq
+import itertools
+import logging
+import threading
+
+import ZODB.utils
+
+
+logger = logging.getLogger(__name__)
+
+
+class Monitor:
+    """Collect timings of loads and stores
+
+    For each method, separate histograms are kept of the time spent in
+    the base storage and the time spent compressing or decompressing.
+    The ``top`` slowest and largest records are kept, with their oids
+    and classes.  Records taking at least ``slow`` seconds are logged.
+    """
+
+    # Upper bounds, in seconds, of the histogram buckets.  There's a
+    # final bucket for longer times.
+    bounds = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 1e-1, 3e-1, 1)
+
+    def __init__(self, top=10, slow=None):
+        if top < 1:
+            raise ValueError("At least one record must be kept", top)
+        self.top = top
+        self.slow = slow
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Discard the data collected so far
+        """
+        with self._lock:
+            self.histograms = {}  # {(method, 'base' or 'codec'): counts}
+            self._slowest = []
+            self._largest = []
+            self._order = itertools.count()
+
+    def record(self, method, oid, data, base_time, codec_time):
+        """Record an operation on the (untransformed) record data
+        """
+        elapsed = base_time + codec_time
+        size = len(data)
+        with self._lock:
+            for part, seconds in (('base', base_time), ('codec', codec_time)):
+                counts = self.histograms.get((method, part))
+                if counts is None:
+                    counts = self.histograms[method, part] = [0] * (
+                        len(self.bounds) + 1)
+                counts[bisect.bisect_right(self.bounds, seconds)] += 1
+
+            entry = None
+            for heap, value in ((self._slowest, elapsed),
+                                (self._largest, size)):
+                if len(heap) < self.top or value > heap[0][0]:
+                    if entry is None:
+                        entry = (method, oid, _classname(data), size,
+                                 base_time, codec_time)
+                    item = (value, next(self._order), entry)
+                    if len(heap) < self.top:
+                        heapq.heappush(heap, item)
+                    else:
+                        heapq.heapreplace(heap, item)
+
+        if self.slow is not None and elapsed >= self.slow:
+            logger.warning(
+                "Slow %s of %s (%s, %s bytes): %.1fms base, %.1fms codec",
+                method, ZODB.utils.oid_repr(oid), _classname(data), size,
+                base_time * 1000, codec_time * 1000)
+
+    def _entries(self, heap):
+        with self._lock:
+            items = sorted(heap, reverse=True)
+        return [dict(zip(('method', 'oid', 'class', 'size',
+                          'base_time', 'codec_time'), entry))
+                for _, _, entry in items]
+
+    def slowest(self):
+        """Return the slowest records recorded, slowest first
+
+        Each is a dictionary with method, oid, class, size, base_time
+        and codec_time keys.
+        """
+        return self._entries(self._slowest)
+
+    def largest(self):
+        """Return the largest records recorded, largest first
+        """
+        return self._entries(self._largest)
+
+    def report(self):
+        """Return a text summary of the data collected
+        """
+        labels = ['<%s' % _format_seconds(bound) for bound in self.bounds]
+        labels.append('>=%s' % _format_seconds(self.bounds[-1]))
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+        for (method, part), counts in histograms:
+            lines.append('%-10s %-5s %s' % (method, part, ' '.join(
+                '%s:%s' % (label, count)
+                for label, count in zip(labels, counts) if count)))
+        for title, entries in (('Slowest', self.slowest()),
+                               ('Largest', self.largest())):
+            if entries:
+                lines.append(title + ':')
+            for entry in entries:
+                lines.append(
+                    '  %(method)-10s %(oid)s %(class)s %(size)s bytes'
+                    ' %(base)s base %(codec)s codec' % dict(
+                        entry,
+                        oid=ZODB.utils.oid_repr(entry['oid']),
+                        base=_format_seconds(entry['base_time']),
+                        codec=_format_seconds(entry['codec_time'])))
+        return '\n'.join(lines)
+
+
+def _classname(data):
+    try:
+        module, name = ZODB.utils.get_pickle_metadata(data)
+    except Exception:
+        return ''
+    return '%s.%s' % (module, name) if name else module
+
+
+def _format_seconds(seconds):
+    if seconds < 1e-3:
+        return '%gus' % round(seconds * 1e6, 1)
+    if seconds < 1:
+        return '%gms' % round(seconds * 1e3, 1)
+    return '%gs' % round(seconds, 1)
+
+
+def from_config(section):
+    return Monitor(section.top, section.slow_threshold)
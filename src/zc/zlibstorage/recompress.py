@@ -0,0 +1,194 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Recompress the current records of a live database
+"""
+import logging
+import threading
+import time
+
+import ZODB.blob
+import ZODB.Connection
+import ZODB.POSException
+
+import zc.zlibstorage
+
+
+logger = logging.getLogger(__name__)
+
+
+class Recompressor:
+    """Rewrite current records whose encoding doesn't match the storage's
+
+    Current object revisions are visited in oid order, using the base
+    storage's ``record_iternext``.  Records that the storage would now
+    encode differently, because compression was enabled or the policy
+    or stages changed, are stored again, with unchanged content, in
+    transactions of at most ``batch_size`` records.  Only encodings, as
+    returned by ``zc.zlibstorage.record_encoding``, are compared, so
+    stages whose output varies, like encryption with random nonces,
+    don't cause records to be rewritten on every pass.
+
+    Work can be limited to ``max_bytes_per_second`` of records read and
+    written and to a ``cpu_fraction`` of the worker's time.  The
+    ``position`` attribute records how far the walk has gotten and can
+    be passed to a new recompressor to resume an interrupted walk.
+    """
+
+    description = 'zc.zlibstorage recompression'
+
+    def __init__(self, storage, position=None, batch_size=100,
+                 max_bytes_per_second=None, cpu_fraction=None):
+        self.storage = storage
+        self.position = position
+        self.batch_size = batch_size
+        self.max_bytes_per_second = max_bytes_per_second
+        self.cpu_fraction = cpu_fraction
+        self.finished = False
+        self.examined = self.rewritten = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _records(self):
+        # Read a batch, returning its records and the position after it
+        base = self.storage.base
+        records = []
+        next = self.position
+        while len(records) < self.batch_size:
+            try:
+                oid, tid, data, next = base.record_iternext(next)
+            except ValueError:
+                # The storage is empty
+                if next is None:
+                    break
+                raise
+            records.append((oid, tid, data))
+            if next is None:
+                break
+        return records, next
+
+    def step(self):
+        """Process a batch of records
+
+        The position is advanced only once the batch's rewrites are
+        committed.  If they conflict with another transaction, the
+        batch is retried by the next step.  Return the number of bytes
+        read and written.
+        """
+        storage = self.storage
+        base = storage.base
+        rewrites = []
+        nbytes = 0
+        records, next = self._records()
+        for oid, tid, data in records:
+            nbytes += len(data)
+            if not data:
+                continue
+            record = storage._untransform(data)
+            if ZODB.blob.is_blob_record(record):
+                # Blob files are tied to the revision that stored them.
+                continue
+            new = storage._store_transform(oid, record)
+            if (zc.zlibstorage.record_encoding(new)
+                    != zc.zlibstorage.record_encoding(data)):
+                rewrites.append((oid, tid, new))
+
+        oids = []
+        if rewrites:
+            t = ZODB.Connection.TransactionMetaData(
+                description=self.description)
+            storage.tpc_begin(t)
+            try:
+                for oid, tid, new in rewrites:
+                    if base.load(oid)[1] != tid:
+                        continue  # Changed since we read it
+                    try:
+                        base.store(oid, tid, new, '', t)
+                    except ZODB.POSException.ConflictError:
+                        continue
+                    oids.append(oid)
+                    nbytes += len(new)
+                try:
+                    storage.tpc_vote(t)
+                except ZODB.POSException.ConflictError:
+                    # Some storages, like ZEO client storages, report
+                    # conflicts when voting.  Try the batch again.
+                    storage.tpc_abort(t)
+                    return nbytes
+                storage.tpc_finish(t, self._invalidate(oids))
+            except BaseException:
+                storage.tpc_abort(t)
+                raise
+
+        self.examined += len(records)
+        self.rewritten += len(oids)
+        self.position = next
+        self.finished = next is None
+        return nbytes
+
+    def _invalidate(self, oids):
+        # Return a tpc_finish callback invalidating the rewritten
+        # records, as a database commit would, while the storage
+        # still holds its commit lock.
+        storage = self.storage
+
+        def invalidate(tid):
+            if oids and storage.db is not None:
+                storage.invalidate(tid, oids)
+        return invalidate
+
+    def _throttle(self, nbytes, elapsed):
+        delay = 0
+        if self.max_bytes_per_second:
+            delay = nbytes / self.max_bytes_per_second - elapsed
+        if self.cpu_fraction:
+            delay = max(
+                delay, elapsed * (1 - self.cpu_fraction) / self.cpu_fraction)
+        if delay > 0:
+            self._stopped.wait(delay)
+
+    def run(self):
+        """Process records until finished or stopped
+        """
+        while not (self.finished or self._stopped.is_set()):
+            start = time.time()
+            nbytes = self.step()
+            self._throttle(nbytes, time.time() - start)
+
+    def _run(self):
+        try:
+            self.run()
+        except Exception:
+            logger.exception("Recompression stopped at %r", self.position)
+        else:
+            logger.info("Recompression examined %s records and rewrote %s",
+                        self.examined, self.rewritten)
+
+    def start(self):
+        """Run in a background thread
+        """
+        self._thread = threading.Thread(
+            target=self._run, name=self.description, daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        """Wait for the background thread to exit
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stop(self, timeout=None):
+        """Stop after the current batch and wait for the thread to exit
+        """
+        self._stopped.set()
+        self.wait(timeout)
@@ -14,6 +14,7 @@
 
 import binascii
 import doctest
+import os
 import unittest
 import zlib
 
@@ -23,9 +24,11 @@ import manuel.testing
 import transaction
 import ZEO.tests.testZEO
 import ZODB.config
+import ZODB.Connection
 import ZODB.FileStorage
 import ZODB.interfaces
 import ZODB.MappingStorage
+import ZODB.POSException
 import ZODB.tests.StorageTestBase
 import ZODB.tests.testFileStorage
 import ZODB.utils
@@ -129,6 +132,177 @@ Since we didn't compress, we can open the storage using a plain file storage:
     """
 
 
+def test_config_policy_errors():
+    r"""
+
+Oid ranges and compression levels are checked when the configuration
+is loaded:
+
+    >>> config = '''
+    ...     %%import zc.zlibstorage
+    ...     <zodb>
+    ...         <zlibstorage>
+    ...             <zlibpolicy>
+    ...                 %s
+    ...             </zlibpolicy>
+    ...             <mappingstorage>
+    ...             </mappingstorage>
+    ...         </zlibstorage>
+    ...     </zodb>
+    ... '''
+    >>> ZODB.config.databaseFromString(config % 'oids 0x20-0x10')
+    ... # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ZConfig.DataConversionError: ('Invalid oid range', '0x20-0x10')...
+
+    >>> ZODB.config.databaseFromString(config % 'level 10')
+    ... # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ZConfig.DataConversionError: ('Invalid compression level', '10')...
+
+    >>> db = ZODB.config.databaseFromString(config % 'oids 7')
+    >>> [rule.oids for rule in db.storage.policy.rules] == [
+    ...     ((ZODB.utils.p64(7), ZODB.utils.p64(7)),)]
+    True
+    >>> db.close()
+
+Records that aren't pickles we can read the class from are treated as
+having an unknown class:
+
+    >>> policy = zc.zlibstorage.Policy(
+    ...     [zc.zlibstorage.Rule(classes=['BTrees.*'], compress=False)])
+    >>> policy.compress(None, b'cat' * 10) == b'.z' + zlib.compress(
+    ...     b'cat' * 10)
+    True
+    >>> policy.compress(None, b'(cat' * 10) == b'.z' + zlib.compress(
+    ...     b'(cat' * 10)
+    True
+    >>> policy.compress(None, b'\x80\x03garbage' * 3) == (
+    ...     b'.z' + zlib.compress(b'\x80\x03garbage' * 3))
+    True
+
+A storage that doesn't compress ignores its policy:
+
+    >>> store = zc.zlibstorage.ZlibStorage(
+    ...     ZODB.MappingStorage.MappingStorage(), compress=False,
+    ...     policy=zc.zlibstorage.Policy(level=9))
+    >>> data = b'x' * 100
+    >>> store._store_transform(ZODB.utils.z64, data) == data
+    True
+    >>> store.transform_record_data(data) == data
+    True
+
+and stores records with the base storage's method:
+
+    >>> store.store.__func__ is store.base.store.__func__
+    True
+    >>> store.close()
+    """
+
+
+def test_max_record_size():
+    r"""
+
+The decompressed size of records can be limited, to protect against
+corrupt or malicious records that would decompress to huge sizes:
+
+    >>> data = b'.z' + zlib.compress(b'x' * 100)
+    >>> zc.zlibstorage.decompress(data, 100) == b'x' * 100
+    True
+    >>> zc.zlibstorage.decompress(data, 99)  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    zc.zlibstorage.RecordTooLarge: ...maximum size, 99
+
+Uncompressed records aren't checked:
+
+    >>> zc.zlibstorage.decompress(b'x' * 100, 99) == b'x' * 100
+    True
+
+Truncated records are still errors:
+
+    >>> zc.zlibstorage.decompress(data[:-4], 100)  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    zlib.error: Error -5 ... incomplete or truncated stream
+
+The limit is set with the ``max_record_size`` storage option and
+applies everywhere records are decompressed:
+
+    >>> config = '''
+    ...     %import zc.zlibstorage
+    ...     <zlibstorage>
+    ...         max-record-size 1KB
+    ...         <filestorage>
+    ...             path data.fs
+    ...         </filestorage>
+    ...     </zlibstorage>
+    ... '''
+    >>> storage = ZODB.config.storageFromString(config)
+    >>> storage.max_record_size
+    1024
+    >>> t = ZODB.Connection.TransactionMetaData()
+    >>> storage.tpc_begin(t)
+    >>> storage.store(ZODB.utils.z64, ZODB.utils.z64, b'x' * 2000, '', t)
+    >>> _ = storage.tpc_vote(t)
+    >>> _ = storage.tpc_finish(t)
+
+Errors raised loading records name them:
+
+    >>> tid = storage.lastTransaction()
+    >>> def show(f, *args):
+    ...     try:
+    ...         f(*args)
+    ...     except zc.zlibstorage.RecordTooLarge as v:
+    ...         print(v)
+    ...         print(v.oid == ZODB.utils.z64, v.tid == tid)
+    >>> show(storage.load, ZODB.utils.z64)  # doctest: +ELLIPSIS
+    Decompressed record is larger ... size, 1024, oid 0x00, tid 0x...
+    True True
+    >>> show(storage.loadBefore, ZODB.utils.z64, ZODB.utils.maxtid)
+    ... # doctest: +ELLIPSIS
+    Decompressed record is larger ... size, 1024, oid 0x00, tid 0x...
+    True True
+    >>> show(storage.loadSerial, ZODB.utils.z64, tid)  # doctest: +ELLIPSIS
+    Decompressed record is larger ... size, 1024, oid 0x00, tid 0x...
+    True True
+    >>> show(storage.record_iternext)  # doctest: +ELLIPSIS
+    Decompressed record is larger ... size, 1024, oid 0x00, tid 0x...
+    True True
+
+    >>> it = storage.iterator()
+    >>> def iterate():
+    ...     for t in it:
+    ...         for r in t:
+    ...             pass
+    >>> show(iterate)  # doctest: +ELLIPSIS
+    Decompressed record is larger ... size, 1024, oid 0x00, tid 0x...
+    True True
+    >>> it.close()
+
+    >>> storage.close()
+
+Monitored storages name records too:
+
+    >>> storage = zc.zlibstorage.ZlibStorage(
+    ...     ZODB.FileStorage.FileStorage('data.fs'), max_record_size=1024,
+    ...     revision_cache_size=10, monitor=zc.zlibstorage.Monitor())
+    >>> show(storage.load, ZODB.utils.z64)  # doctest: +ELLIPSIS
+    Decompressed record is larger ... size, 1024, oid 0x00, tid 0x...
+    True True
+    >>> show(storage.loadBefore, ZODB.utils.z64, ZODB.utils.maxtid)
+    ... # doctest: +ELLIPSIS
+    Decompressed record is larger ... size, 1024, oid 0x00, tid 0x...
+    True True
+    >>> show(storage.loadSerial, ZODB.utils.z64, tid)  # doctest: +ELLIPSIS
+    Decompressed record is larger ... size, 1024, oid 0x00, tid 0x...
+    True True
+    >>> storage.close()
+    """
+
+
 def test_mixed_compressed_and_uncompressed_and_packing():
     r"""
 We can deal with a mixture of compressed and uncompressed data.
@@ -212,6 +386,619 @@ Let's try packing the file 4 ways:
     """
 
 
+def test_recompress_batches_and_resume():
+    r"""
+
+Recompression proceeds in batches, recording its position so that it
+can be resumed:
+
+    >>> db = ZODB.DB('data.fs')
+    >>> conn = db.open()
+    >>> for i in range(5):
+    ...     conn.root()[i] = conn.root().__class__((j, j) for j in range(100))
+    >>> transaction.commit()
+    >>> db.close()
+
+    >>> storage = zc.zlibstorage.ZlibStorage(
+    ...     ZODB.FileStorage.FileStorage('data.fs'))
+    >>> recompressor = zc.zlibstorage.Recompressor(storage, batch_size=2)
+    >>> _ = recompressor.step()
+    >>> recompressor.finished, recompressor.position == ZODB.utils.p64(2)
+    (False, True)
+    >>> last = storage.lastTransaction()
+
+    >>> recompressor = zc.zlibstorage.Recompressor(
+    ...     storage, position=recompressor.position, batch_size=2)
+    >>> recompressor.run()
+    >>> recompressor.finished, recompressor.examined, recompressor.rewritten
+    (True, 4, 4)
+    >>> len(list(storage.iterator(ZODB.utils.p64(ZODB.utils.u64(last)+1))))
+    2
+
+Running again finds nothing to do:
+
+    >>> recompressor = zc.zlibstorage.Recompressor(storage)
+    >>> recompressor.run()
+    >>> recompressor.examined, recompressor.rewritten
+    (6, 0)
+    >>> storage.close()
+
+Records stored uncompressed by policy are decompressed:
+
+    >>> storage = zc.zlibstorage.ZlibStorage(
+    ...     ZODB.FileStorage.FileStorage('data.fs'),
+    ...     policy=zc.zlibstorage.Policy(
+    ...         [zc.zlibstorage.Rule(oids=[(0, 1)], compress=False)]))
+    >>> recompressor = zc.zlibstorage.Recompressor(storage)
+    >>> recompressor.run()
+    >>> recompressor.rewritten
+    2
+    >>> [storage.base.load(ZODB.utils.p64(i))[0][:2] == b'.z'
+    ...  for i in range(3)]
+    [False, False, True]
+    >>> storage.close()
+
+Only record encodings are compared, including the class of
+compression level zlib records:
+
+    >>> zc.zlibstorage.record_encoding(b'.z' + zlib.compress(b'x' * 100, 9))
+    (b'.z', 3)
+    >>> zc.zlibstorage.record_encoding(b'.z' + zlib.compress(b'x' * 100))
+    (b'.z', 2)
+    >>> zc.zlibstorage.record_encoding(b'.s\x02zcxxxx')
+    (b'.s\x02zc', None)
+    >>> zc.zlibstorage.record_encoding(b'xxxx')
+    (b'', None)
+
+    >>> storage = zc.zlibstorage.ZlibStorage(
+    ...     ZODB.FileStorage.FileStorage('data.fs'),
+    ...     policy=zc.zlibstorage.Policy(level=9))
+    >>> recompressor = zc.zlibstorage.Recompressor(storage)
+    >>> recompressor.run()
+    >>> recompressor.rewritten
+    6
+    >>> recompressor = zc.zlibstorage.Recompressor(storage)
+    >>> recompressor.run()
+    >>> recompressor.rewritten
+    0
+    >>> storage.close()
+
+so stages whose output varies, like encryption with random nonces,
+don't cause records to be rewritten again:
+
+    >>> class Nonce:
+    ...     tag = b'n'
+    ...     def encode(self, data, header):
+    ...         return os.urandom(4) + data
+    ...     def decode(self, data, header):
+    ...         return data[4:]
+    >>> storage = zc.zlibstorage.ZlibStorage(
+    ...     ZODB.FileStorage.FileStorage('data.fs'), stages=[Nonce()],
+    ...     strict_stages=False)
+    >>> recompressor = zc.zlibstorage.Recompressor(storage)
+    >>> recompressor.run()
+    >>> recompressor.rewritten
+    6
+    >>> for _ in range(2):
+    ...     recompressor = zc.zlibstorage.Recompressor(storage)
+    ...     recompressor.run()
+    ...     print(recompressor.examined, recompressor.rewritten)
+    6 0
+    6 0
+    >>> storage.base.load(ZODB.utils.z64)[0][:4]
+    b'.s\x02z'
+    >>> storage.close()
+
+A batch whose transaction fails isn't skipped.  Conflicts reported
+when voting, as ZEO client storages do, cause the batch to be retried:
+
+    >>> db = ZODB.DB('failing.fs')
+    >>> conn = db.open()
+    >>> for i in range(5):
+    ...     conn.root()[i] = conn.root().__class__((j, j) for j in range(100))
+    >>> transaction.commit()
+    >>> db.close()
+    >>> storage = zc.zlibstorage.ZlibStorage(
+    ...     ZODB.FileStorage.FileStorage('failing.fs'))
+    >>> vote = storage.tpc_vote
+    >>> def fail_once(error):
+    ...     def tpc_vote(t):
+    ...         storage.tpc_vote = vote
+    ...         raise error
+    ...     storage.tpc_vote = tpc_vote
+
+    >>> recompressor = zc.zlibstorage.Recompressor(storage, batch_size=2)
+    >>> fail_once(ZODB.POSException.ConflictError())
+    >>> _ = recompressor.step()
+    >>> recompressor.position, recompressor.examined, recompressor.rewritten
+    (None, 0, 0)
+    >>> _ = recompressor.step()
+    >>> recompressor.position == ZODB.utils.p64(2), recompressor.rewritten
+    (True, 2)
+
+Other errors stop the recompressor, with its position at the start of
+the failed batch, so resuming retries it:
+
+    >>> fail_once(ZODB.POSException.StorageError('oops'))
+    >>> recompressor.run()
+    Traceback (most recent call last):
+    ...
+    ZODB.POSException.StorageError: oops
+    >>> recompressor.position == ZODB.utils.p64(2), recompressor.rewritten
+    (True, 2)
+    >>> recompressor = zc.zlibstorage.Recompressor(
+    ...     storage, position=recompressor.position, batch_size=2)
+    >>> recompressor.run()
+    >>> recompressor.examined, recompressor.rewritten
+    (4, 4)
+    >>> recompressor = zc.zlibstorage.Recompressor(storage)
+    >>> recompressor.run()
+    >>> recompressor.examined, recompressor.rewritten
+    (6, 0)
+
+Rewritten records are invalidated while the transaction is finished,
+before it becomes visible:
+
+    >>> storage.close()
+    >>> storage = zc.zlibstorage.ZlibStorage(
+    ...     ZODB.FileStorage.FileStorage('failing.fs'), compress=False)
+    >>> invalidated = []
+    >>> class DB:
+    ...     def invalidate(self, tid, oids):
+    ...         invalidated.append(tid)
+    ...         print('invalidate', tid == storage.lastTransaction(),
+    ...               [ZODB.utils.u64(oid) for oid in oids])
+    ...     def transform_record_data(self, data):
+    ...         return data
+    ...     untransform_record_data = transform_record_data
+    >>> storage.registerDB(DB())
+    >>> recompressor = zc.zlibstorage.Recompressor(storage, batch_size=3)
+    >>> _ = recompressor.step()
+    invalidate False [0, 1, 2]
+    >>> invalidated == [storage.lastTransaction()]
+    True
+    >>> storage.close()
+
+Empty storages are handled:
+
+    >>> storage = zc.zlibstorage.ZlibStorage(
+    ...     ZODB.FileStorage.FileStorage('empty.fs'))
+    >>> recompressor = zc.zlibstorage.Recompressor(storage)
+    >>> recompressor.run()
+    >>> recompressor.finished, recompressor.examined
+    (True, 0)
+    >>> storage.close()
+    """
+
+
+def test_pipeline():
+    r"""
+
+In pipeline mode, each record is compressed in a separate thread while
+the previous record is written to the base storage.  The first record
+is written directly, so the base storage checks the transaction, and
+the last record is written when the transaction is voted:
+
+    >>> storage = zc.zlibstorage.ZlibStorage(
+    ...     ZODB.FileStorage.FileStorage('data.fs'), pipeline=True)
+    >>> t = ZODB.Connection.TransactionMetaData()
+    >>> storage.tpc_begin(t)
+    >>> for i in range(3):
+    ...     storage.store(ZODB.utils.p64(i), ZODB.utils.z64, b'x' * 100,
+    ...                   '', t)
+    >>> [ZODB.utils.u64(pending[0]) for pending in storage._pipelined.values()]
+    [2]
+    >>> _ = storage.tpc_vote(t)
+    >>> storage._pipelined
+    {}
+    >>> _ = storage.tpc_finish(t)
+    >>> for i in range(3):
+    ...     data, _ = storage.base.load(ZODB.utils.p64(i))
+    ...     print(data == b'.z' + zlib.compress(b'x' * 100))
+    True
+    True
+    True
+
+Records pending when a transaction is aborted are discarded:
+
+    >>> t = ZODB.Connection.TransactionMetaData()
+    >>> storage.tpc_begin(t)
+    >>> for i in range(3, 5):
+    ...     storage.store(ZODB.utils.p64(i), ZODB.utils.z64, b'x' * 100,
+    ...                   '', t)
+    >>> storage.tpc_abort(t)
+    >>> storage._pipelined
+    {}
+    >>> storage.base.load(ZODB.utils.p64(3))
+    Traceback (most recent call last):
+    ...
+    ZODB.POSException.POSKeyError: 0x03
+
+    >>> storage.close()
+
+The ``pipeline`` option enables pipelining in configuration files:
+
+    >>> storage = ZODB.config.storageFromString('''
+    ...     %import zc.zlibstorage
+    ...     <zlibstorage>
+    ...         pipeline true
+    ...         <mappingstorage>
+    ...         </mappingstorage>
+    ...     </zlibstorage>
+    ... ''')
+    >>> storage.pipeline
+    True
+    >>> storage.close()
+
+Stores are recorded by monitors, with the time spent compressing in
+the separate thread:
+
+    >>> storage = zc.zlibstorage.ZlibStorage(
+    ...     ZODB.MappingStorage.MappingStorage(), pipeline=True,
+    ...     monitor=zc.zlibstorage.Monitor())
+    >>> t = ZODB.Connection.TransactionMetaData()
+    >>> storage.tpc_begin(t)
+    >>> for i in range(3):
+    ...     storage.store(ZODB.utils.p64(i), ZODB.utils.z64, b'x' * 100,
+    ...                   '', t)
+    >>> _ = storage.tpc_vote(t)
+    >>> _ = storage.tpc_finish(t)
+    >>> histograms = storage.monitor.histograms
+    >>> sum(histograms['store', 'base']), sum(histograms['store', 'codec'])
+    (3, 3)
+    >>> sorted(ZODB.utils.u64(entry['oid'])
+    ...        for entry in storage.monitor.largest())
+    [0, 1, 2]
+    >>> storage.close()
+
+Server storages don't compress when storing, so don't pipeline:
+
+    >>> storage = zc.zlibstorage.ServerZlibStorage(
+    ...     ZODB.MappingStorage.MappingStorage(), pipeline=True)
+    >>> storage.pipeline
+    False
+    >>> storage.close()
+    """
+
+
+def test_revision_cache():
+    r"""
+
+The revision cache holds up to a number of bytes of revisions,
+discarding the least recently used:
+
+    >>> cache = zc.zlibstorage.RevisionCache(10)
+    >>> cache.put(1, b'1111')
+    >>> cache.put(2, b'2222')
+    >>> cache.get(1)
+    b'1111'
+    >>> cache.put(3, b'3333')
+    >>> cache.get(2) is None
+    True
+    >>> cache.get(1), cache.get(3)
+    (b'1111', b'3333')
+    >>> len(cache), cache.bytes
+    (2, 8)
+
+Revisions larger than the cache aren't kept:
+
+    >>> cache.put(4, b'4' * 11)
+    >>> cache.get(4) is None
+    True
+    >>> len(cache), cache.bytes
+    (2, 8)
+
+Hits count revisions found and misses revisions added:
+
+    >>> cache.hits, cache.misses
+    (3, 4)
+
+Loading uncompressed revisions doesn't involve the cache:
+
+    >>> storage = zc.zlibstorage.ZlibStorage(
+    ...     ZODB.MappingStorage.MappingStorage(), revision_cache_size=1000)
+    >>> t = ZODB.Connection.TransactionMetaData()
+    >>> storage.tpc_begin(t)
+    >>> storage.store(ZODB.utils.z64, ZODB.utils.z64, b'raw', '', t)
+    >>> storage.store(ZODB.utils.p64(1), ZODB.utils.z64, b'x' * 100, '', t)
+    >>> _ = storage.tpc_vote(t)
+    >>> tid = storage.tpc_finish(t)
+    >>> for oid in (ZODB.utils.z64, ZODB.utils.p64(1)) * 2:
+    ...     _ = storage.loadSerial(oid, tid)
+    >>> cache = storage.revision_cache
+    >>> cache.hits, cache.misses, len(cache), cache.bytes
+    (1, 1, 1, 100)
+    >>> storage.close()
+
+Storages without a cache size have no cache, and the cache can be
+configured:
+
+    >>> zc.zlibstorage.ZlibStorage(
+    ...     ZODB.MappingStorage.MappingStorage()).revision_cache is None
+    True
+
+    >>> storage = ZODB.config.storageFromString('''
+    ...     %import zc.zlibstorage
+    ...     <zlibstorage>
+    ...         revision-cache-size 10MB
+    ...         <filestorage>
+    ...             path data.fs
+    ...         </filestorage>
+    ...     </zlibstorage>
+    ... ''')
+    >>> storage.revision_cache.size
+    10485760
+    >>> storage.close()
+    """
+
+
+def test_stages():
+    r"""
+
+Records that aren't worth compressing still pass through the stages,
+which are passed the record header, so it's covered by the checksum:
+
+    >>> transform = zc.zlibstorage.Transform([zc.zlibstorage.Checksum()])
+    >>> transformed = transform.encode(None, b'short')
+    >>> transformed == (b'.s\1c' + b'short' + zlib.crc32(
+    ...     b'short', zlib.crc32(b'.s\1c')).to_bytes(4, 'big'))
+    True
+    >>> transform.decode(transformed)
+    b'short'
+
+Records already transformed with stages are left alone, but records
+compressed without them are passed through the stages:
+
+    >>> transform.encode(None, transformed) == transformed
+    True
+    >>> transformed = transform.encode(
+    ...     None, b'.z' + zlib.compress(b'x' * 100))
+    >>> transformed[:5]
+    b'.s\x02zc'
+    >>> transform.decode(transformed) == b'x' * 100
+    True
+
+By default, records that weren't passed through all of the stages are
+rejected, so records can't be replaced by unprotected ones:
+
+    >>> transform.decode(b'.z' + zlib.compress(b'x' * 100))
+    ... # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ZODB.POSException.StorageError: Record wasn't transformed with the ...
+    >>> transform.decode(b'raw')  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ZODB.POSException.StorageError: Record wasn't transformed with the ...
+    >>> transform.decode(b'.s\1zxx')  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ZODB.POSException.StorageError: ("Record wasn't ...", b'.s\x01z')
+    >>> transform.decode(b'')
+    b''
+
+Unless they aren't strict:
+
+    >>> lenient = zc.zlibstorage.Transform(
+    ...     [zc.zlibstorage.Checksum()], strict=False)
+    >>> lenient.decode(b'.z' + zlib.compress(b'x' * 100)) == b'x' * 100
+    True
+    >>> lenient.decode(b'raw')
+    b'raw'
+    >>> transformed = transform.encode(None, b'short')
+
+Changing the header is detected by stages that cover it:
+
+    >>> lenient.decode(b'.s\2zc' + transformed[4:])
+    Traceback (most recent call last):
+    ...
+    zc.zlibstorage.ChecksumError: Record checksum doesn't match
+
+Damaged records are detected:
+
+    >>> transform.decode(transformed[:-1] + b'!')
+    Traceback (most recent call last):
+    ...
+    zc.zlibstorage.ChecksumError: Record checksum doesn't match
+
+    >>> transform.decode(b'.s\2cx' + b'data')
+    Traceback (most recent call last):
+    ...
+    ZODB.POSException.StorageError: ('Unknown record transformation', b'x')
+
+    >>> transform.decode(b'.s')
+    Traceback (most recent call last):
+    ...
+    ZODB.POSException.StorageError: ('Truncated record header', b'.s')
+
+    >>> transform.decode(b'.s\3zc')
+    Traceback (most recent call last):
+    ...
+    ZODB.POSException.StorageError: ('Truncated record header', b'.s\x03zc')
+
+    >>> transform.decode(b'.s\1cxx')
+    Traceback (most recent call last):
+    ...
+    zc.zlibstorage.ChecksumError: Record checksum doesn't match
+
+Storages without stages refuse to return records transformed with
+stages:
+
+    >>> zc.zlibstorage.decompress(transformed)  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ZODB.POSException.StorageError: Record was transformed with stages, ...
+
+Policies and size limits apply:
+
+    >>> transform = zc.zlibstorage.Transform(
+    ...     [zc.zlibstorage.Checksum()],
+    ...     policy=zc.zlibstorage.Policy([zc.zlibstorage.Rule(
+    ...         oids=[(0, 0)], compress=False)]),
+    ...     max_record_size=50)
+    >>> transform.encode(ZODB.utils.z64, b'x' * 100)[:4]
+    b'.s\x01c'
+    >>> transformed = transform.encode(ZODB.utils.p64(1), b'x' * 100)
+    >>> transformed[:5]
+    b'.s\x02zc'
+    >>> transform.decode(transformed)  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    zc.zlibstorage.RecordTooLarge: ...
+
+Storages reject records that weren't passed through their stages,
+unless configured not to:
+
+    >>> storage = zc.zlibstorage.ZlibStorage(
+    ...     ZODB.FileStorage.FileStorage('legacy.fs'))
+    >>> t = ZODB.Connection.TransactionMetaData()
+    >>> storage.tpc_begin(t)
+    >>> storage.store(ZODB.utils.z64, ZODB.utils.z64, b'x' * 100, '', t)
+    >>> _ = storage.tpc_vote(t)
+    >>> _ = storage.tpc_finish(t)
+    >>> storage.close()
+
+    >>> config = '''
+    ...     %%import zc.zlibstorage
+    ...     <zlibstorage>
+    ...         stage zc.zlibstorage.Checksum
+    ...         %s
+    ...         <filestorage>
+    ...             path legacy.fs
+    ...         </filestorage>
+    ...     </zlibstorage>
+    ... '''
+    >>> storage = ZODB.config.storageFromString(config % '')
+    >>> storage.strict_stages
+    True
+    >>> storage.load(ZODB.utils.z64)  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ZODB.POSException.StorageError: Record wasn't transformed with the ...
+    >>> storage.close()
+
+    >>> storage = ZODB.config.storageFromString(
+    ...     config % 'strict-stages false')
+    >>> storage.load(ZODB.utils.z64)[0] == b'x' * 100
+    True
+    >>> storage.close()
+
+Stage tags must be distinct single bytes, other than the compression
+tag:
+
+    >>> zc.zlibstorage.Transform([zc.zlibstorage.Encryption(
+    ...     None, None, b'z')])  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ValueError: ('Stage tags must be distinct ...', b'z')
+    >>> zc.zlibstorage.Transform(
+    ...     [zc.zlibstorage.Checksum()] * 2)  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ValueError: ('Stage tags must be distinct ...', b'cc')
+    """
+
+
+def test_monitor():
+    r"""
+
+The monitor keeps the top slowest and largest records:
+
+    >>> monitor = zc.zlibstorage.Monitor(top=2)
+    >>> for i, (size, seconds) in enumerate(
+    ...         [(10, .3), (30, .1), (20, .2), (40, .0001)]):
+    ...     monitor.record('load', ZODB.utils.p64(i), b'x' * size,
+    ...                    seconds, 0)
+    >>> [(ZODB.utils.u64(e['oid']), e['base_time'])
+    ...  for e in monitor.slowest()]
+    [(0, 0.3), (2, 0.2)]
+    >>> [(ZODB.utils.u64(e['oid']), e['size']) for e in monitor.largest()]
+    [(3, 40), (1, 30)]
+    >>> monitor.histograms['load', 'base']
+    [0, 0, 0, 1, 0, 0, 0, 0, 0, 2, 1, 0]
+    >>> monitor.histograms['load', 'codec']
+    [4, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+
+At least one record must be kept, including in configuration files:
+
+    >>> zc.zlibstorage.Monitor(top=0)
+    Traceback (most recent call last):
+    ...
+    ValueError: ('At least one record must be kept', 0)
+    >>> ZODB.config.storageFromString('''
+    ...     %import zc.zlibstorage
+    ...     <zlibstorage>
+    ...         <zlibmonitor>
+    ...             top 0
+    ...         </zlibmonitor>
+    ...         <mappingstorage>
+    ...         </mappingstorage>
+    ...     </zlibstorage>
+    ... ''')  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ZConfig.DataConversionError: ('At least one record must be kept', 0)...
+
+Slow records are logged:
+
+    >>> import zope.testing.loggingsupport
+    >>> handler = zope.testing.loggingsupport.InstalledHandler(
+    ...     'zc.zlibstorage.monitor')
+    >>> monitor = zc.zlibstorage.Monitor(slow=.1)
+    >>> monitor.record('store', ZODB.utils.p64(1), b'x' * 100, .1, .02)
+    >>> monitor.record('store', ZODB.utils.p64(2), b'x' * 100, .01, .02)
+    >>> print(handler)
+    zc.zlibstorage.monitor WARNING
+      Slow store of 0x01 (, 100 bytes): 100.0ms base, 20.0ms codec
+    >>> handler.uninstall()
+
+Monitored storages handle missing revisions and revision caches:
+
+    >>> storage = zc.zlibstorage.ZlibStorage(
+    ...     ZODB.FileStorage.FileStorage('data.fs'),
+    ...     monitor=zc.zlibstorage.Monitor(), revision_cache_size=1000)
+    >>> db = ZODB.DB(storage)
+    >>> conn = db.open()
+    >>> conn.root.x = b'x' * 100
+    >>> transaction.commit()
+    >>> storage.loadBefore(ZODB.utils.z64, ZODB.utils.p64(1)) is None
+    True
+    >>> tid = storage.lastTransaction()
+    >>> storage.loadSerial(ZODB.utils.z64, tid) == storage.loadSerial(
+    ...     ZODB.utils.z64, tid)
+    True
+    >>> sum(storage.monitor.histograms['loadSerial', 'base'])
+    1
+    >>> db.close()
+
+Server storages don't transform records when loading and storing
+them, so can't be monitored:
+
+    >>> zc.zlibstorage.ServerZlibStorage(
+    ...     ZODB.MappingStorage.MappingStorage(),
+    ...     monitor=zc.zlibstorage.Monitor())  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ValueError: Server storages don't transform records ...
+
+and ``serverzlibstorage`` sections don't accept ``zlibmonitor``
+sections:
+
+    >>> ZODB.config.storageFromString('''
+    ...     %import zc.zlibstorage
+    ...     <serverzlibstorage>
+    ...         <zlibmonitor>
+    ...         </zlibmonitor>
+    ...         <mappingstorage>
+    ...         </mappingstorage>
+    ...     </serverzlibstorage>
+    ... ''')  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ZConfig.ConfigurationSyntaxError: ...type='zlibmonitor'...
+    """
+
+
 class Dummy:
 
     def invalidateCache(self):
@@ -291,6 +1078,56 @@ If the data are small or otherwise not compressable, it is left as is:
     """
 
 
+def test_subclass_overrides():
+    """
+Subclasses can override the methods the storage binds at construction
+and use the inherited implementations:
+
+    >>> class Storage(zc.zlibstorage.ZlibStorage):
+    ...     def load(self, oid, version=''):
+    ...         print('load', ZODB.utils.u64(oid))
+    ...         return super().load(oid, version)
+    ...     def store(self, oid, serial, data, version, transaction):
+    ...         print('store', ZODB.utils.u64(oid))
+    ...         return super().store(oid, serial, data, version, transaction)
+    ...     def transform_record_data(self, data):
+    ...         print('transform')
+    ...         return super().transform_record_data(data)
+
+    >>> for options in ({}, dict(pipeline=True),
+    ...                 dict(monitor=zc.zlibstorage.Monitor())):
+    ...     storage = Storage(ZODB.MappingStorage.MappingStorage(), **options)
+    ...     t = ZODB.Connection.TransactionMetaData()
+    ...     storage.tpc_begin(t)
+    ...     storage.store(ZODB.utils.z64, ZODB.utils.z64, b'x' * 100, '', t)
+    ...     _ = storage.tpc_vote(t)
+    ...     _ = storage.tpc_finish(t)
+    ...     print(storage.load(ZODB.utils.z64)[0] == b'x' * 100,
+    ...           storage.base.load(ZODB.utils.z64)[0][:2])
+    ...     _ = storage.transform_record_data(b'x' * 100)
+    ...     storage.close()
+    store 0
+    load 0
+    True b'.z'
+    transform
+    store 0
+    load 0
+    True b'.z'
+    transform
+    store 0
+    load 0
+    True b'.z'
+    transform
+
+Methods that aren't overridden are still bound directly:
+
+    >>> storage = Storage(ZODB.MappingStorage.MappingStorage())
+    >>> 'loadSerial' in storage.__dict__, 'load' in storage.__dict__
+    (True, False)
+    >>> storage.close()
+    """
+
+
 def dont_double_compress():
     """
     This test is a bit artificial in that we want to make sure we
@@ -323,6 +1160,24 @@ class FileStorageZlibTests(ZODB.tests.testFileStorage.FileStorageTests):
             ZODB.FileStorage.FileStorage('FileStorageTests.fs', **kwargs))
 
 
+class FileStorageZlibPipelineTests(
+        ZODB.tests.testFileStorage.FileStorageTests):
+
+    def open(self, **kwargs):
+        self._storage = zc.zlibstorage.ZlibStorage(
+            ZODB.FileStorage.FileStorage('FileStorageTests.fs', **kwargs),
+            pipeline=True)
+
+
+class FileStorageZlibStagesTests(
+        ZODB.tests.testFileStorage.FileStorageTests):
+
+    def open(self, **kwargs):
+        self._storage = zc.zlibstorage.ZlibStorage(
+            ZODB.FileStorage.FileStorage('FileStorageTests.fs', **kwargs),
+            stages=[zc.zlibstorage.Checksum()])
+
+
 class FileStorageZlibTestsWithBlobsEnabled(
         ZODB.tests.testFileStorage.FileStorageTests):
 
@@ -376,6 +1231,14 @@ class FileStorageClientZlibZEOZlibTests(FileStorageZEOZlibTests):
         return zc.zlibstorage.ZlibStorage(client)
 
 
+class FileStorageClientPipelineZlibZEOZlibTests(FileStorageZEOZlibTests):
+
+    use_extension_bytes = True
+
+    def _wrap_client(self, client):
+        return zc.zlibstorage.ZlibStorage(client, pipeline=True)
+
+
 class FileStorageClientZlibZEOServerZlibTests(
     FileStorageClientZlibZEOZlibTests
 ):
@@ -472,10 +1335,13 @@ def test_suite():
     suite = unittest.TestSuite()
     for class_ in (
         FileStorageZlibTests,
+        FileStorageZlibPipelineTests,
+        FileStorageZlibStagesTests,
         FileStorageZlibTestsWithBlobsEnabled,
         FileStorageZlibRecoveryTest,
         FileStorageZEOZlibTests,
         FileStorageClientZlibZEOZlibTests,
+        FileStorageClientPipelineZlibZEOZlibTests,
         FileStorageClientZlibZEOServerZlibTests,
     ):
         s = unittest.defaultTestLoader.loadTestsFromTestCase(class_,)